@@ -402,7 +402,7 @@ with right_col:
                         
                         result = compose_one_bytes(item_img, template_img, **opts)
                         if result:
-                            ss.preview_list.append(result[0].getvalue())
+                            ss.preview_list.append(result[0])
                             template_name = Path(template_file.name).stem
                             ss.preview_info.append(f"{template_name}")
                     except Exception:
@@ -436,11 +436,11 @@ with right_col:
                                 
                                 result = compose_one_bytes(item_img, template_img, **opts)
                                 if result:
-                                    img_buf, ext = result
+                                    img_bytes, ext = result
                                     item_name = Path(item_file.name).stem
                                     template_code = Path(template_file.name).stem
                                     filename = f"{item_name}_C_{template_code}.{ext}"
-                                    zf.writestr(filename, img_buf.getvalue())
+                                    zf.writestr(filename, img_bytes)
                                     count += 1
                             except:
                                 pass
@@ -0,0 +1,151 @@
+import threading
+
+import numpy as np
+
+try:
+    from numba import config, njit, prange, set_num_threads, types
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+    # Streamlit은 메인 스레드가 아닌 ScriptRunner 스레드에서 import하는데,
+    # TBB 레이어는 이 경우 인터프리터 종료 시 멈춤. workqueue로 고정한다.
+    config.THREADING_LAYER = "workqueue"
+
+# workqueue 스레딩 레이어는 여러 스레드의 동시 parallel 커널 호출을 지원하지 않음.
+# 커널 자체가 병렬이므로 호출만 직렬화한다.
+_launch_lock = threading.Lock()
+
+
+def limit_threads(n: int):
+    """커널 병렬 스레드 수 제한 (numba가 없으면 무시)"""
+    if HAS_NUMBA:
+        set_num_threads(n)
+
+
+def shadow_lut(alpha_value: int) -> np.ndarray:
+    """blur된 알파(0~255) → 실제 그림자 알파 변환표
+
+    기존 paste(shadow, mask=shadow) 방식과 같도록 preset 알파로 스케일한 값(s)에
+    제곱 응답(s * s / 255)을 적용한다.
+    """
+    s = np.arange(256, dtype=np.int32) * max(0, min(255, int(alpha_value))) // 255
+    return ((s * s + 127) // 255).astype(np.uint8)
+
+
+# 두 커널 모두 기존 "투명 레이어에 paste(img, mask=img) → Image.alpha_composite" 결과와
+# 비트 단위로 같도록 Pillow의 정수 연산을 그대로 따른다.
+# 레이어 paste는 색과 알파에 알파를 한 번 더 곱하고(이중 알파 응답),
+# alpha_composite는 7비트 고정소수점 계수를 쓴다 (libImaging/AlphaComposite.c).
+
+if HAS_NUMBA:
+    _SHADOW_SIG = types.void(
+        types.Array(types.uint8, 3, "A"),
+        types.Array(types.uint8, 2, "A", readonly=True),
+        types.Array(types.uint8, 1, "A", readonly=True),
+    )
+
+    @njit(_SHADOW_SIG, parallel=True, fastmath=True, cache=True)
+    def _stamp_shadow_roi(dst, alpha, lut):
+        h, w = alpha.shape
+        for yy in prange(h):
+            for xx in range(w):
+                sa = np.int64(lut[alpha[yy, xx]])
+                if sa == 0:
+                    continue
+                blend = np.int64(dst[yy, xx, 3]) * (255 - sa)
+                outa255 = sa * 255 + blend
+                coef2 = 255 * 128 - sa * 255 * 255 * 128 // outa255
+                for c in range(3):
+                    v = np.int64(dst[yy, xx, c]) * coef2 + (128 << 7)
+                    dst[yy, xx, c] = (((v >> 8) + v) >> 8) >> 7
+                t = outa255 + 128
+                dst[yy, xx, 3] = ((t >> 8) + t) >> 8
+
+    _OVER_SIG = types.void(
+        types.Array(types.uint8, 3, "A"),
+        types.Array(types.uint8, 3, "A", readonly=True),
+    )
+
+    @njit(_OVER_SIG, parallel=True, fastmath=True, cache=True)
+    def _alpha_over_roi(dst, src):
+        h, w = src.shape[:2]
+        for yy in prange(h):
+            for xx in range(w):
+                a = np.int64(src[yy, xx, 3])
+                if a == 0:
+                    continue
+                if a == 255:
+                    for c in range(4):
+                        dst[yy, xx, c] = src[yy, xx, c]
+                    continue
+                t = a * a + 128
+                sa = ((t >> 8) + t) >> 8
+                if sa == 0:
+                    continue
+                blend = np.int64(dst[yy, xx, 3]) * (255 - sa)
+                outa255 = sa * 255 + blend
+                coef1 = sa * 255 * 255 * 128 // outa255
+                coef2 = 255 * 128 - coef1
+                for c in range(3):
+                    t = np.int64(src[yy, xx, c]) * a + 128
+                    v = (((t >> 8) + t) >> 8) * coef1 + np.int64(dst[yy, xx, c]) * coef2 + (128 << 7)
+                    dst[yy, xx, c] = (((v >> 8) + v) >> 8) >> 7
+                t = outa255 + 128
+                dst[yy, xx, 3] = ((t >> 8) + t) >> 8
+else:
+    def _div255(v):
+        v = v + 128
+        return ((v >> 8) + v) >> 8
+
+    def _over(dst, src_rgb, sa):
+        # src_rgb / sa는 레이어 paste가 끝난 값, sa == 0인 픽셀은 dst 그대로
+        blend = dst[..., 3].astype(np.int64) * (255 - sa)
+        outa255 = sa * 255 + blend
+        coef1 = sa * (255 * 255 * 128) // np.maximum(outa255, 1)
+        coef2 = 255 * 128 - coef1
+        v = src_rgb * coef1[..., None] + dst[..., :3].astype(np.int64) * coef2[..., None] + (128 << 7)
+        rgb = (((v >> 8) + v) >> 8) >> 7
+        keep = (sa == 0)[..., None]
+        dst[..., :3] = np.where(keep, dst[..., :3], rgb)
+        dst[..., 3] = np.where(keep[..., 0], dst[..., 3], _div255(outa255))
+
+    def _stamp_shadow_roi(dst, alpha, lut):
+        sa = lut[alpha].astype(np.int64)
+        _over(dst, np.zeros(sa.shape + (3,), dtype=np.int64), sa)
+
+    def _alpha_over_roi(dst, src):
+        a = src[..., 3].astype(np.int64)
+        _over(dst, _div255(src[..., :3].astype(np.int64) * a[..., None]), _div255(a * a))
+
+
+def stamp_shadow(dst_rgba: np.ndarray, alpha_u8: np.ndarray, lut: np.ndarray, x0: int, y0: int):
+    """검은 그림자를 dst_rgba의 (x0, y0) 위치에 in-place로 합성 (lut은 shadow_lut 결과)"""
+    H, W = dst_rgba.shape[:2]
+    h, w = alpha_u8.shape
+    dx0, dy0 = max(0, x0), max(0, y0)
+    dx1, dy1 = min(W, x0 + w), min(H, y0 + h)
+    if dx0 >= dx1 or dy0 >= dy1:
+        return
+    with _launch_lock:
+        _stamp_shadow_roi(
+            dst_rgba[dy0:dy1, dx0:dx1],
+            alpha_u8[dy0 - y0:dy1 - y0, dx0 - x0:dx1 - x0],
+            lut,
+        )
+
+
+def alpha_over(dst_rgba: np.ndarray, src_rgba: np.ndarray, x0: int, y0: int):
+    """src_rgba를 dst_rgba의 (x0, y0) 위치에 in-place 알파 합성 (겹치는 영역만 처리)"""
+    H, W = dst_rgba.shape[:2]
+    h, w = src_rgba.shape[:2]
+    dx0, dy0 = max(0, x0), max(0, y0)
+    dx1, dy1 = min(W, x0 + w), min(H, y0 + h)
+    if dx0 >= dx1 or dy0 >= dy1:
+        return
+    with _launch_lock:
+        _alpha_over_roi(
+            dst_rgba[dy0:dy1, dx0:dx1],
+            src_rgba[dy0 - y0:dy1 - y0, dx0 - x0:dx1 - x0],
+        )
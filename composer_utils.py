@@ -1,7 +1,20 @@
 import io
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
 from PIL import Image, ImageFilter
 
+from composer_kernels import alpha_over, limit_threads, shadow_lut, stamp_shadow
+
+try:
+    import cv2
+    HAS_CV2 = True
+except ImportError:
+    HAS_CV2 = False
+
 SHADOW_PRESETS = {
     "off": {"blur": 0, "alpha": 0, "offset_x": 0.0, "offset_y": 0.0},
     "light": {"blur": 6, "alpha": 100, "offset_x": 0.006, "offset_y": 0.006},
@@ -9,6 +22,10 @@ SHADOW_PRESETS = {
     "strong": {"blur": 24, "alpha": 220, "offset_x": 0.018, "offset_y": 0.018},
 }
 
+# 그림자 알파 변환표는 preset마다 한 번만 계산
+for _preset in SHADOW_PRESETS.values():
+    _preset["_lut"] = shadow_lut(_preset["alpha"])
+
 
 def ensure_rgba(img: Image.Image) -> Image.Image:
     if img.mode == "RGBA":
@@ -23,107 +40,308 @@ def ensure_rgba(img: Image.Image) -> Image.Image:
 
 
 def has_useful_alpha(img: Image.Image) -> bool:
-    img = ensure_rgba(img)
-    a = img.getchannel("A")
-    extrema = a.getextrema()
-    if not extrema:
+    # 알파 채널이 없는 모드는 픽셀을 읽지 않고 바로 판단
+    if img.mode == "P":
+        if "transparency" not in img.info:
+            return False
+        img = img.convert("RGBA")
+    if "A" not in img.getbands():
+        return False
+    a = np.asarray(img.getchannel("A"))
+    if a.size == 0:
         return False
-    min_a, max_a = extrema
+    min_a, max_a = int(a.min()), int(a.max())
     return not (min_a == 255 and max_a == 255) and not (min_a == 0 and max_a == 0)
 
 
+@lru_cache(maxsize=512)
 def compute_anchor_position(bg_size, fg_size, anchor: str):
     W, H = bg_size
     w, h = fg_size
-    positions = {
-        "center": ((W - w) // 2, (H - h) // 2),
-        "top": ((W - w) // 2, 0),
-        "bottom": ((W - w) // 2, H - h),
-        "left": (0, (H - h) // 2),
-        "right": (W - w, (H - h) // 2),
-        "top-left": (0, 0),
-        "top-right": (W - w, 0),
-        "bottom-left": (0, H - h),
-        "bottom-right": (W - w, H - h),
-    }
-    return positions.get(anchor, positions["center"])
+    if anchor == "top":
+        return (W - w) // 2, 0
+    if anchor == "bottom":
+        return (W - w) // 2, H - h
+    if anchor == "left":
+        return 0, (H - h) // 2
+    if anchor == "right":
+        return W - w, (H - h) // 2
+    if anchor == "top-left":
+        return 0, 0
+    if anchor == "top-right":
+        return W - w, 0
+    if anchor == "bottom-left":
+        return 0, H - h
+    if anchor == "bottom-right":
+        return W - w, H - h
+    # "center" 및 알 수 없는 값
+    return (W - w) // 2, (H - h) // 2
 
 
-def compose_one_bytes(item_img: Image.Image, template_img: Image.Image, **opts):
+def resize_item(item_img: Image.Image, ratio: float) -> Image.Image:
     item_rgba = ensure_rgba(item_img)
-    template_rgba = ensure_rgba(template_img)
-
-    ratio = float(opts.get("resize_ratio", 1.0))
     if ratio <= 0:
         ratio = 1.0
     if ratio != 1.0:
         new_size = (max(1, int(item_rgba.width * ratio)), max(1, int(item_rgba.height * ratio)))
-        item_rgba = item_rgba.resize(new_size, Image.LANCZOS)
+        if HAS_CV2 and ratio < 1.0:
+            # 축소는 OpenCV INTER_AREA가 더 빠름 (확대는 PIL LANCZOS가 더 빠름)
+            # PIL처럼 premultiplied 상태로 보간해야 투명 영역의 RGB가 가장자리로 번지지 않음
+            arr = np.asarray(item_rgba.convert("RGBa"))
+            arr = cv2.resize(arr, new_size, interpolation=cv2.INTER_AREA)
+            item_rgba = Image.fromarray(arr, "RGBa").convert("RGBA")
+        else:
+            # 프리셋 범위(0.7~1.3)의 배율은 BICUBIC으로도 LANCZOS와 육안 차이가 없음
+            resample = Image.BICUBIC if 0.7 <= ratio <= 1.3 else Image.LANCZOS
+            item_rgba = item_rgba.resize(new_size, resample)
+    return item_rgba
 
-    anchor = opts.get("anchor", "center")
-    x, y = compute_anchor_position(template_rgba.size, item_rgba.size, anchor)
 
-    composition_mode = opts.get("composition_mode", "normal")
-    item_has_alpha = has_useful_alpha(item_rgba)
+class CompositeCtx:
+    """템플릿 크기별 작업 버퍼(스레드별)와 템플릿 RGBA 배열을 재사용하는 합성 컨텍스트"""
 
-    if composition_mode == "frame":
-        final_img = Image.new("RGBA", template_rgba.size, (255, 255, 255, 255))
+    def __init__(self, max_templates: int = 8, max_buffers: int = 2):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()
+        self._max_templates = max_templates
+        self._max_buffers = max_buffers
 
-        item_layer = Image.new("RGBA", final_img.size, (0, 0, 0, 0))
-        item_layer.paste(item_rgba, (x, y), item_rgba)
-        final_img = Image.alpha_composite(final_img, item_layer)
+    def buffer(self, size) -> np.ndarray:
+        # 워커 스레드/프로세스는 오래 유지되므로 최근 크기의 버퍼만 보관
+        W, H = size
+        pool = self._local.__dict__.setdefault("pool", OrderedDict())
+        buf = pool.get((H, W))
+        if buf is None:
+            buf = pool[(H, W)] = np.empty((H, W, 4), dtype=np.uint8)
+            while len(pool) > self._max_buffers:
+                pool.popitem(last=False)
+        else:
+            pool.move_to_end((H, W))
+        return buf
 
-        template_layer = Image.new("RGBA", final_img.size, (0, 0, 0, 0))
-        template_layer.paste(template_rgba, (0, 0), template_rgba)
-        final_img = Image.alpha_composite(final_img, template_layer)
-    else:
-        final_img = template_rgba.copy()
+    def _template_entry(self, template_img: Image.Image):
+        # 항목에 이미지 자체를 보관하므로 id가 재사용될 일이 없음
+        key = id(template_img)
+        with self._lock:
+            entry = self._templates.get(key)
+            if entry is None:
+                arr = np.asarray(ensure_rgba(template_img))
+                opaque = template_img.mode == "RGB" or bool((arr[..., 3] == 255).all())
+                entry = self._templates[key] = (template_img, arr, opaque)
+                while len(self._templates) > self._max_templates:
+                    self._templates.popitem(last=False)
+            else:
+                self._templates.move_to_end(key)
+        return entry
 
-        if item_has_alpha:
-            preset_name = str(opts.get("shadow_preset", "off"))
-            preset = SHADOW_PRESETS.get(preset_name, SHADOW_PRESETS["off"])
+    def template_array(self, template_img: Image.Image) -> np.ndarray:
+        return self._template_entry(template_img)[1]
 
-            if preset.get("alpha", 0) > 0:
-                alpha_mask = item_rgba.getchannel("A")
+    def template_is_opaque(self, template_img: Image.Image) -> bool:
+        return self._template_entry(template_img)[2]
 
-                blur_radius = int(preset.get("blur", 0))
-                if blur_radius > 0:
-                    alpha_blurred = alpha_mask.filter(ImageFilter.GaussianBlur(blur_radius))
-                else:
-                    alpha_blurred = alpha_mask
+    def clear(self):
+        # 다른 스레드의 버퍼까지 한 번에 놓아주도록 thread-local 자체를 교체
+        with self._lock:
+            self._templates.clear()
+            self._local = threading.local()
 
-                scale = max(0, min(255, int(preset.get("alpha", 0)))) / 255.0
-                alpha_scaled = alpha_blurred.point(lambda p: int(p * scale))
 
-                shadow_rgba = Image.new("RGBA", item_rgba.size, (0, 0, 0, 0))
-                shadow_rgba.putalpha(alpha_scaled)
+_ctx = CompositeCtx()
+# compose_one_bytes 호출자는 매번 템플릿을 새로 디코딩하므로 id 기반 캐시는 호출 안에서만 유효
+# → 직전 템플릿 하나만 보관
+_oneshot_ctx = CompositeCtx(max_templates=1)
 
-                dx = int(template_rgba.width * float(preset.get("offset_x", 0.0)))
-                dy = int(template_rgba.height * float(preset.get("offset_y", 0.0)))
 
-                shadow_layer = Image.new("RGBA", final_img.size, (0, 0, 0, 0))
-                shadow_layer.paste(shadow_rgba, (x + dx, y + dy), shadow_rgba)
-                final_img = Image.alpha_composite(final_img, shadow_layer)
+def blur_alpha(alpha_mask: Image.Image, blur_radius: int) -> Image.Image:
+    if blur_radius >= 4:
+        # 그림자는 충분히 흐리므로 축소 → blur → 확대로 근사
+        # 축소 해상도의 GaussianBlur(BoxBlur 3회)로 분산을 맞추되, 축소/확대 보간이 더하는 분산(약 scale²/3)은 뺌
+        scale = 2 if blur_radius <= 12 else 4
+        small_size = (max(1, alpha_mask.width // scale), max(1, alpha_mask.height // scale))
+        small = alpha_mask.resize(small_size, Image.BILINEAR)
+        sigma = math.sqrt(blur_radius ** 2 - scale ** 2 / 3) / scale
+        small = small.filter(ImageFilter.GaussianBlur(sigma))
+        return small.resize(alpha_mask.size, Image.BILINEAR)
+    if blur_radius > 0:
+        return alpha_mask.filter(ImageFilter.GaussianBlur(blur_radius))
+    return alpha_mask
 
-        item_layer = Image.new("RGBA", final_img.size, (0, 0, 0, 0))
-        item_layer.paste(item_rgba, (x, y), item_rgba)
-        final_img = Image.alpha_composite(final_img, item_layer)
 
-    img_buf = io.BytesIO()
+def make_composer(opts: dict, ctx: CompositeCtx = _ctx):
+    """opts를 한 번만 해석해, 이 설정에서 쓰이는 경로만 담은 (item, template) → (bytes, 확장자) 함수를 반환"""
+    ratio = float(opts.get("resize_ratio", 1.0))
+    anchor = opts.get("anchor", "center")
+    composition_mode = opts.get("composition_mode", "normal")
     out_format = str(opts.get("out_format", "JPEG")).upper()
+    quality = int(opts.get("quality", 92))
+    if opts.get("archive"):
+        # ZIP 저장용: 4:2:0 서브샘플링 + 허프만 최적화 + 프로그레시브 (고화질 옵션은 4:4:4)
+        jpeg_opts = {"subsampling": 0 if opts.get("high_quality") else 2, "optimize": True, "progressive": True}
+    else:
+        jpeg_opts = {}
+
+    preset_name = str(opts.get("shadow_preset", "off"))
+    preset = SHADOW_PRESETS.get(preset_name, SHADOW_PRESETS["off"])
+    shadow_on = preset.get("alpha", 0) > 0
+    # 축소 디코딩된 템플릿(미리보기)에서는 blur 반경도 같은 배율로 보정
+    blur_radius = int(round(preset.get("blur", 0) * float(opts.get("render_scale", 1.0))))
+    offset_x = float(preset.get("offset_x", 0.0))
+    offset_y = float(preset.get("offset_y", 0.0))
+    lut = preset["_lut"]
 
     if out_format == "JPEG":
-        if final_img.mode == 'RGBA':
-            background = Image.new("RGB", final_img.size, (255, 255, 255))
-            background.paste(final_img, mask=final_img.split()[3])
-            final_img = background
-        else:
-            final_img = final_img.convert("RGB")
-        final_img.save(img_buf, format="JPEG", quality=int(opts.get("quality", 92)))
         ext = "jpg"
+
+        def save(final_img, fp):
+            if final_img.mode == 'RGBA':
+                alpha = final_img.getchannel("A")
+                if alpha.getextrema() == (255, 255):
+                    final_img = final_img.convert("RGB")
+                else:
+                    background = Image.new("RGB", final_img.size, (255, 255, 255))
+                    background.paste(final_img, mask=alpha)
+                    final_img = background
+            elif final_img.mode != "RGB":
+                final_img = final_img.convert("RGB")
+            final_img.save(fp, format="JPEG", quality=quality, **jpeg_opts)
     else:
-        final_img.save(img_buf, format="PNG")
         ext = "png"
 
-    img_buf.seek(0)
-    return img_buf, ext
+        def save(final_img, fp):
+            final_img.save(fp, format="PNG")
+
+    def encode(final_img):
+        img_buf = io.BytesIO()
+        save(final_img, img_buf)
+        return img_buf.getvalue(), ext
+
+    if composition_mode == "frame":
+        def compose(item_img, template_img):
+            item_rgba = resize_item(item_img, ratio)
+            x, y = compute_anchor_position(template_img.size, item_rgba.size, anchor)
+
+            buf = ctx.buffer(template_img.size)
+            if ctx.template_is_opaque(template_img):
+                # 불투명 템플릿은 상품을 완전히 덮으므로 블렌딩 없이 복사
+                np.copyto(buf, ctx.template_array(template_img))
+            else:
+                buf.fill(255)
+                alpha_over(buf, np.asarray(item_rgba), x, y)
+                alpha_over(buf, ctx.template_array(template_img), 0, 0)
+            final_img = Image.fromarray(buf, "RGBA")
+            if out_format == "JPEG":
+                # 흰 배경 위에 합성했으므로 항상 불투명 → 평탄화 없이 RGB 변환
+                final_img = final_img.convert("RGB")
+            return encode(final_img)
+    else:
+        def compose(item_img, template_img):
+            item_rgba = resize_item(item_img, ratio)
+            x, y = compute_anchor_position(template_img.size, item_rgba.size, anchor)
+
+            has_shadow = shadow_on and has_useful_alpha(item_rgba)
+            buf = ctx.buffer(template_img.size)
+            np.copyto(buf, ctx.template_array(template_img))
+            if has_shadow:
+                alpha_blurred = blur_alpha(item_rgba.getchannel("A"), blur_radius)
+                dx = int(template_img.width * offset_x)
+                dy = int(template_img.height * offset_y)
+                # 상품 주변 투명 여백은 건너뛰고 그림자가 실제로 있는 영역만 합성
+                bbox = alpha_blurred.getbbox()
+                if bbox:
+                    left, top = bbox[:2]
+                    shadow_roi = np.asarray(alpha_blurred.crop(bbox))
+                    stamp_shadow(buf, shadow_roi, lut, x + dx + left, y + dy + top)
+
+            alpha_over(buf, np.asarray(item_rgba), x, y)
+            return encode(Image.fromarray(buf, "RGBA"))
+
+    return compose
+
+
+def compose_one_bytes(item_img: Image.Image, template_img: Image.Image, **opts):
+    return make_composer(opts, _oneshot_ctx)(item_img, template_img)
+
+
+# 프로세스 단위 합성 캐시: 프로세스 풀 워커는 세션 동안 유지되므로 최근 항목만 보관하고,
+# 미리보기 스레드가 쓰는 메인 프로세스에서는 배치가 끝나면 clear_caches()로 비움
+_template_cache = OrderedDict()
+_item_cache = OrderedDict()
+_composer_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache, key, value, max_entries):
+    with _cache_lock:
+        cache[key] = value
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+    return value
+
+
+def clear_caches():
+    _template_cache.clear()
+    _item_cache.clear()
+    _composer_cache.clear()
+    _ctx.clear()
+
+
+def init_worker():
+    """프로세스 풀 워커 초기화: 병렬화는 워커 수로 하므로 워커 안의 numba/OpenCV 스레드는 1개만"""
+    limit_threads(1)
+    if HAS_CV2:
+        cv2.setNumThreads(1)
+
+
+def open_source(src):
+    # 원본은 bytes(같은 프로세스) 또는 파일 경로(프로세스 풀)
+    return Image.open(src if isinstance(src, str) else io.BytesIO(src))
+
+
+def load_template(template_src, preview_size=None):
+    """템플릿 디코딩 + 모드 변환을 워커 캐시에 보관하고 (이미지, 디코딩 배율) 반환"""
+    key = (template_src, preview_size)
+    cached = _cache_get(_template_cache, key)
+    if cached is None:
+        template_img = open_source(template_src)
+        full_width = template_img.width
+        if preview_size and template_img.mode == "RGB":
+            # JPEG는 DCT 단계에서 1/2, 1/4, 1/8로 축소 디코딩 (다른 포맷은 무시됨)
+            k = preview_size / max(template_img.size)
+            template_img.draft("RGB", (max(1, int(template_img.width * k)), max(1, int(template_img.height * k))))
+        template_img = template_img if template_img.mode == "RGB" else ensure_rgba(template_img)
+        template_img.load()
+        cached = _cache_put(_template_cache, key, (template_img, template_img.width / full_width), 8)
+    return cached
+
+
+def compose_task(item_src, template_src, opts: dict, item_img=None):
+    """합성 작업 단위: 원본 파일(bytes 또는 경로)을 받아 (결과 bytes, 확장자) 반환
+
+    같은 프로세스에서 호출할 때는 이미 디코딩된 상품 이미지(item_img)를 넘겨 디코딩을 생략할 수 있다.
+    """
+    template_img, render_scale = load_template(template_src, opts.get("preview_size"))
+
+    ratio = float(opts.get("resize_ratio", 1.0)) * render_scale
+    item_rgba = _cache_get(_item_cache, (item_src, ratio))
+    if item_rgba is None:
+        if item_img is None:
+            item_img = open_source(item_src)
+        item_rgba = _cache_put(_item_cache, (item_src, ratio), resize_item(item_img, ratio), 8)
+
+    composer_opts = {**opts, "resize_ratio": 1.0, "render_scale": render_scale}
+    composer_key = tuple(sorted(composer_opts.items()))
+    composer = _cache_get(_composer_cache, composer_key)
+    if composer is None:
+        composer = _cache_put(_composer_cache, composer_key, make_composer(composer_opts), 32)
+
+    return composer(item_rgba, template_img)
@@ -1,18 +1,28 @@
 from __future__ import annotations
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
 import io
+import multiprocessing
+import os
 import zipfile
 import re
+import tempfile
 from datetime import datetime
 
+import PIL
 import streamlit as st
 from PIL import Image as PILImage
+from streamlit.logger import get_logger
 
 from composer_utils import (
-    compose_one_bytes,
+    clear_caches,
+    compose_task,
+    init_worker,
     SHADOW_PRESETS,
     has_useful_alpha,
-    ensure_rgba,
 )
 
 
@@ -31,6 +41,9 @@ def load_settings():
             "SHOW_MANUAL": ui.get("show_manual_button", True),
             "OUTPUT_FORMAT": output.get("default_format", "JPEG"),
             "JPEG_QUALITY": int(output.get("jpeg_quality", 95)),
+            "PREVIEW_SIZE": int(ui.get("preview_size", 480)),
+            "PREVIEW_QUALITY": int(ui.get("preview_quality", 75)),
+            "MAX_WORKERS": int(settings.get("max_workers", 0)),
         }
     except Exception:
         return {
@@ -42,10 +55,25 @@ def load_settings():
             "SHOW_MANUAL": True,
             "OUTPUT_FORMAT": "JPEG",
             "JPEG_QUALITY": 95,
+            "PREVIEW_SIZE": 480,
+            "PREVIEW_QUALITY": 75,
+            "MAX_WORKERS": 0,
         }
 
 
 CONFIG = load_settings()
+# 세션당 합성 결과 캐시 상한 (인코딩된 바이트 합계)
+COMPOSE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+@st.cache_resource
+def log_pillow_build():
+    # Pillow-SIMD는 버전 문자열에 .postN 이 붙음
+    variant = "Pillow-SIMD" if ".post" in PIL.__version__ else "Pillow"
+    get_logger(__name__).info("Image backend: %s %s", variant, PIL.__version__)
+
+
+log_pillow_build()
 
 
 @st.dialog("📖 사용 가이드")
@@ -192,15 +220,36 @@ def validate_template_names(files):
     return (False, errors) if errors else (True, [])
 
 
+def file_hash(file_bytes):
+    # 파일 식별용 해시: 합성 결과 캐시 키로 쓰이므로 앞부분만이 아니라 전체 내용을 해시
+    return hashlib.sha1(file_bytes).hexdigest()
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def decoded(name, size, content_hash, _file_bytes):
+    # 🎯 미리보기 스레드용: 상품 이미지는 한 번만 디코딩해서 재사용 (공유 객체이므로 읽기 전용으로만 사용)
+    img = PILImage.open(io.BytesIO(_file_bytes))
+    img.load()
+    return img
+
+
+@st.cache_data(show_spinner=False)
+def probe_item(name, size, content_hash, _file_bytes):
+    # 🎯 설정 변경으로 인한 재실행 시 재분석하지 않도록 파일 단위로 캐싱
+    # 헤더만 읽으므로 알파 없는 모드(RGB/L)는 픽셀을 디코딩하지 않음
+    img = PILImage.open(io.BytesIO(_file_bytes))
+    return {"has_alpha": has_useful_alpha(img), "size": img.size}
+
+
 def analyze_combinations(item_files, template_files):
     valid_combinations = []
     invalid_combinations = []
 
     for item_file in item_files:
         try:
-            item_file.seek(0)  # 🎯 파일 포인터 초기화
-            item_img = PILImage.open(item_file)
-            has_alpha = has_useful_alpha(ensure_rgba(item_img))
+            file_bytes = item_file.getvalue()
+            content_hash = file_hash(file_bytes)
+            has_alpha = probe_item(item_file.name, item_file.size, content_hash, file_bytes)["has_alpha"]
         except:
             continue
 
@@ -227,12 +276,102 @@ def analyze_combinations(item_files, template_files):
     }
 
 
+def build_compose_opts(template_file, out_format, **extra):
+    template_ext = Path(template_file.name).suffix.lower()
+    composition_mode = "frame" if template_ext == ".png" else "normal"
+    shadow_preset = ss.shadow_preset if composition_mode == "normal" else "off"
+
+    return {
+        "anchor": ss.anchor,
+        "resize_ratio": ss.resize_ratio,
+        "shadow_preset": shadow_preset,
+        "out_format": out_format,
+        "composition_mode": composition_mode,
+        **extra,
+    }
+
+
+def load_uploads(files):
+    # (파일명, 크기) → (원본 bytes, 내용 해시)
+    uploads = {}
+    for f in files:
+        file_bytes = f.getvalue()
+        uploads[(f.name, f.size)] = (file_bytes, file_hash(file_bytes))
+    return uploads
+
+
+def spool_uploads(uploads, spool_dir):
+    # 🎯 프로세스 풀에는 bytes 대신 파일 경로만 넘겨, 조합마다 같은 파일을 IPC로 다시 보내지 않음
+    spooled = {}
+    for key, (file_bytes, content_hash) in uploads.items():
+        fd, path = tempfile.mkstemp(dir=spool_dir)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(file_bytes)
+        spooled[key] = (path, content_hash)
+    return spooled
+
+
+def usable_cpus():
+    # 컨테이너/taskset으로 제한된 경우 os.cpu_count()는 호스트 전체 코어 수를 돌려줌
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # CPU 쿼터는 affinity에 드러나지 않으므로 설정(max_workers)으로 상한 지정
+    return min(cpus, CONFIG["MAX_WORKERS"]) if CONFIG["MAX_WORKERS"] > 0 else cpus
+
+
+@st.cache_resource(show_spinner=False)
+def compose_executor():
+    # 🎯 워커 기동(numpy/PIL/numba import)은 비싸므로 프로세스 풀은 한 번만 만들어 재사용
+    # numba 병렬 런타임은 fork 이후 안전하지 않으므로 spawn 사용
+    # 워커끼리 이미 병렬이므로 워커 안의 numba/OpenCV 스레드는 1개로 제한 (코어 수² 스레드 방지)
+    return ProcessPoolExecutor(
+        max_workers=usable_cpus(),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+    )
+
+
+def decode_upload(f, uploads):
+    file_bytes, content_hash = uploads[(f.name, f.size)]
+    return decoded(f.name, f.size, content_hash, file_bytes)
+
+
+def submit_compose(executor, item_upload, template_upload, opts, **task_kwargs):
+    # 🎯 같은 (상품, 템플릿, 설정) 조합은 이전 합성 결과를 재사용
+    item_src, item_hash = item_upload
+    template_src, template_hash = template_upload
+    key = (item_hash, template_hash, tuple(sorted(opts.items())))
+
+    cached = ss.compose_cache.get(key)
+    if cached is not None:
+        ss.compose_cache.move_to_end(key)
+        future = Future()
+        future.set_result(cached)
+    else:
+        future = executor.submit(compose_task, item_src, template_src, opts, **task_kwargs)
+    return key, future
+
+
+def remember_composed(key, result):
+    old = ss.compose_cache.pop(key, None)
+    if old is not None:
+        ss.compose_cache_bytes -= len(old[0])
+    ss.compose_cache[key] = result
+    ss.compose_cache_bytes += len(result[0])
+    while ss.compose_cache_bytes > COMPOSE_CACHE_BYTES:
+        _, (img_bytes, _) = ss.compose_cache.popitem(last=False)
+        ss.compose_cache_bytes -= len(img_bytes)
+
+
 # 🎯 최적화된 세션 상태 관리
 ss = st.session_state
 defaults = {
     "anchor": "center",
     "resize_ratio": 1.0,
     "shadow_preset": "off",
+    "high_quality": False,
     "preview_list": [],
     "preview_info": [],
     "zip_cache": None,
@@ -243,6 +382,8 @@ defaults = {
     "last_file_sig": None,
     "last_settings_sig": None,
     "needs_preview_regen": False,
+    "compose_cache": OrderedDict(),
+    "compose_cache_bytes": 0,
 }
 for k, v in defaults.items():
     ss.setdefault(k, v)
@@ -363,12 +504,23 @@ with right_col:
         help="JPG 템플릿 + 투명 배경 상품에만 적용됩니다"
     )
 
+    # JPEG 저장 옵션이므로 출력 형식이 JPEG일 때만 표시
+    is_jpeg_output = CONFIG["OUTPUT_FORMAT"].upper() == "JPEG"
+    if is_jpeg_output:
+        ss.high_quality = st.toggle(
+            "💎 고화질 JPEG",
+            value=False,
+            help="색상 서브샘플링 없이 저장합니다 (파일 크기가 커집니다)"
+        )
+
     st.divider()
 
     st.markdown(f"**👁️ 갤러리 미리보기** (최대 {CONFIG['MAX_PREVIEW_COUNT']}개)")
 
     # 🎯 설정 변경 감지
     current_settings_sig = (ss.anchor, ss.resize_ratio, ss.shadow_preset)
+    if is_jpeg_output:
+        current_settings_sig += (ss.high_quality,)
     if ss.last_settings_sig != current_settings_sig:
         ss.needs_preview_regen = True
         ss.last_settings_sig = current_settings_sig
@@ -384,75 +536,102 @@ with right_col:
             preview_combinations = valid_combinations[:CONFIG["MAX_PREVIEW_COUNT"]]
 
             with st.spinner("미리보기 및 다운로드 파일 생성 중..."):
-                # 미리보기 생성
-                for item_file, template_file, mode in preview_combinations:
-                    try:
-                        item_file.seek(0)
-                        template_file.seek(0)
-
-                        item_img = PILImage.open(item_file)
-                        template_img = PILImage.open(template_file)
-
-                        template_ext = Path(template_file.name).suffix.lower()
-                        composition_mode = "frame" if template_ext == ".png" else "normal"
-                        shadow_preset = ss.shadow_preset if composition_mode == "normal" else "off"
-
-                        opts = {
-                            "anchor": ss.anchor,
-                            "resize_ratio": ss.resize_ratio,
-                            "shadow_preset": shadow_preset,
-                            "out_format": "PNG",
-                            "composition_mode": composition_mode,
-                        }
-
-                        result = compose_one_bytes(item_img, template_img, **opts)
-                        if result:
-                            ss.preview_list.append(result[0].getvalue())
+                # 업로드 파일은 한 번만 읽어 모든 조합에서 재사용
+                item_data = load_uploads(item_files)
+                template_data = load_uploads(template_files)
+
+                # 미리보기는 작은 이미지라 프로세스 기동 비용 없이 스레드로 (PIL 디코딩/인코딩은 GIL 해제)
+                # ZIP용 원본 크기 합성은 세션 간 공유되는 프로세스 풀로 병렬 처리
+                executor = compose_executor()
+                with ThreadPoolExecutor(
+                    max_workers=min(8, usable_cpus()),
+                ) as preview_executor, tempfile.TemporaryDirectory() as spool_dir:
+                    item_spool = spool_uploads(item_data, spool_dir)
+                    template_spool = spool_uploads(template_data, spool_dir)
+
+                    preview_jobs = []
+                    for item_file, template_file, mode in preview_combinations:
+                        try:
+                            # 같은 프로세스의 스레드이므로 디코딩된 상품 이미지를 그대로 전달
+                            item_img = decode_upload(item_file, item_data)
+                        except Exception:
+                            # 분석은 헤더만 읽으므로 손상된 파일은 여기서 실패 → 해당 조합만 제외
+                            continue
+                        key, future = submit_compose(
+                            preview_executor,
+                            item_data[(item_file.name, item_file.size)],
+                            template_data[(template_file.name, template_file.size)],
+                            build_compose_opts(
+                                template_file,
+                                "JPEG",
+                                quality=CONFIG["PREVIEW_QUALITY"],
+                                preview_size=CONFIG["PREVIEW_SIZE"],
+                            ),
+                            item_img=item_img,
+                        )
+                        preview_jobs.append((key, future, template_file))
+                    zip_jobs = {}
+                    for item_file, template_file, mode in valid_combinations:
+                        try:
+                            key, future = submit_compose(
+                                executor,
+                                item_spool[(item_file.name, item_file.size)],
+                                template_spool[(template_file.name, template_file.size)],
+                                build_compose_opts(
+                                    template_file,
+                                    CONFIG["OUTPUT_FORMAT"],
+                                    quality=CONFIG["JPEG_QUALITY"],
+                                    archive=True,
+                                    high_quality=ss.high_quality,
+                                ),
+                            )
+                        except BrokenProcessPool:
+                            # 워커가 비정상 종료된 풀은 버리고 다음 실행에서 새로 만듦
+                            compose_executor.clear()
+                            break
+                        zip_jobs[future] = (key, item_file, template_file)
+
+                    # 미리보기 생성
+                    for key, future, template_file in preview_jobs:
+                        try:
+                            img_bytes, ext = future.result()
+                            remember_composed(key, (img_bytes, ext))
+                            ss.preview_list.append(img_bytes)
                             template_name = Path(template_file.name).stem
                             ss.preview_info.append(f"{template_name}")
-                    except Exception:
-                        pass
-
-                # ZIP 파일 생성
-                if valid_combinations:
-                    zip_buf = io.BytesIO()
-                    count = 0
-
-                    with zipfile.ZipFile(zip_buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                        for item_file, template_file, mode in valid_combinations:
-                            try:
-                                item_file.seek(0)
-                                template_file.seek(0)
-
-                                item_img = PILImage.open(item_file)
-                                template_img = PILImage.open(template_file)
-
-                                template_ext = Path(template_file.name).suffix.lower()
-                                composition_mode = "frame" if template_ext == ".png" else "normal"
-                                shadow_preset = ss.shadow_preset if composition_mode == "normal" else "off"
-
-                                opts = {
-                                    "anchor": ss.anchor,
-                                    "resize_ratio": ss.resize_ratio,
-                                    "shadow_preset": shadow_preset,
-                                    "out_format": CONFIG["OUTPUT_FORMAT"],
-                                    "quality": CONFIG["JPEG_QUALITY"],
-                                    "composition_mode": composition_mode,
-                                }
-
-                                result = compose_one_bytes(item_img, template_img, **opts)
-                                if result:
-                                    img_buf, ext = result
+                        except Exception:
+                            pass
+                    clear_caches()
+
+                    # ZIP 파일 생성 (완료되는 순서대로 기록)
+                    if valid_combinations:
+                        zip_buf = io.BytesIO()
+                        count = 0
+
+                        # JPEG는 이미 압축되어 있으므로 재압축하지 않고 저장만 함
+                        if CONFIG["OUTPUT_FORMAT"].upper() == "JPEG":
+                            zip_opts = {"compression": zipfile.ZIP_STORED}
+                        else:
+                            zip_opts = {"compression": zipfile.ZIP_DEFLATED, "compresslevel": 1}
+
+                        with zipfile.ZipFile(zip_buf, "w", **zip_opts) as zf:
+                            for future in as_completed(zip_jobs):
+                                key, item_file, template_file = zip_jobs[future]
+                                try:
+                                    img_bytes, ext = future.result()
+                                    remember_composed(key, (img_bytes, ext))
                                     item_name = Path(item_file.name).stem
                                     template_code = Path(template_file.name).stem
                                     filename = f"{item_name}_C_{template_code}.{ext}"
-                                    zf.writestr(filename, img_buf.getvalue())
+                                    zf.writestr(filename, img_bytes)
                                     count += 1
-                            except:
-                                pass
+                                except BrokenProcessPool:
+                                    compose_executor.clear()
+                                except:
+                                    pass
 
-                    zip_buf.seek(0)
-                    ss.zip_cache = (zip_buf.getvalue(), count, len(valid_combinations) - count)
+                        zip_buf.seek(0)
+                        ss.zip_cache = (zip_buf.getvalue(), count, len(valid_combinations) - count)
 
             # 재생성 완료
             ss.needs_preview_regen = False
@@ -0,0 +1,113 @@
+import io
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from composer_kernels import alpha_over, shadow_lut, stamp_shadow  # noqa: E402
+from composer_utils import blur_alpha, compose_one_bytes, ensure_rgba  # noqa: E402
+
+
+def layer_over(base, img, pos):
+    # 기존 합성 방식: 투명 레이어에 paste(img, mask=img) 후 alpha_composite
+    layer = Image.new("RGBA", base.size, (0, 0, 0, 0))
+    layer.paste(img, pos, img)
+    return Image.alpha_composite(base, layer)
+
+
+def baseline_compose(item_img, template_img, anchor_xy, composition_mode):
+    template_rgba = ensure_rgba(template_img)
+    item_rgba = ensure_rgba(item_img)
+    if composition_mode == "frame":
+        final_img = Image.new("RGBA", template_rgba.size, (255, 255, 255, 255))
+        final_img = layer_over(final_img, item_rgba, anchor_xy)
+        return layer_over(final_img, template_rgba, (0, 0))
+    return layer_over(template_rgba.copy(), item_rgba, anchor_xy)
+
+
+def random_rgba(rng, size):
+    arr = rng.integers(0, 256, size=(size[1], size[0], 4), dtype=np.uint8)
+    # 완전 투명/불투명 픽셀도 충분히 섞이도록
+    arr[..., 3][rng.random(arr.shape[:2]) < 0.2] = 0
+    arr[..., 3][rng.random(arr.shape[:2]) < 0.2] = 255
+    return arr
+
+
+def test_alpha_over_matches_layer_composite():
+    rng = np.random.default_rng(0)
+    dst = random_rgba(rng, (64, 48))
+    src = random_rgba(rng, (40, 30))
+
+    expected = layer_over(Image.fromarray(dst, "RGBA"), Image.fromarray(src, "RGBA"), (-5, 20))
+    alpha_over(dst, src, -5, 20)
+
+    assert np.array_equal(dst, np.asarray(expected))
+
+
+def test_stamp_shadow_matches_layer_composite():
+    rng = np.random.default_rng(1)
+    dst = random_rgba(rng, (64, 48))
+    mask = rng.integers(0, 256, size=(30, 40), dtype=np.uint8)
+    alpha_value = 160
+
+    scale = alpha_value / 255.0
+    shadow = Image.new("RGBA", (40, 30), (0, 0, 0, 0))
+    shadow.putalpha(Image.fromarray(mask, "L").point(lambda p: int(p * scale)))
+    expected = layer_over(Image.fromarray(dst, "RGBA"), shadow, (30, -4))
+    stamp_shadow(dst, mask, shadow_lut(alpha_value), 30, -4)
+
+    assert np.array_equal(dst, np.asarray(expected))
+
+
+def sample_item():
+    item = Image.new("RGBA", (300, 240), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(item)
+    draw.ellipse((20, 20, 280, 220), fill=(200, 30, 60, 255))
+    draw.rectangle((100, 80, 200, 160), fill=(20, 200, 60, 128))
+    draw.rectangle((0, 0, 60, 40), fill=(250, 250, 10, 30))
+    return item
+
+
+def sample_template(kind):
+    if kind == "jpg":
+        tpl = Image.new("RGB", (640, 480), (240, 230, 200))
+        ImageDraw.Draw(tpl).rectangle((0, 300, 640, 480), fill=(120, 100, 80))
+        return tpl
+    tpl = Image.new("RGBA", (640, 480), (50, 50, 200, 255))
+    draw = ImageDraw.Draw(tpl)
+    draw.rectangle((100, 80, 540, 400), fill=(0, 0, 0, 0))
+    draw.rectangle((80, 60, 560, 80), fill=(255, 255, 255, 100))
+    return tpl
+
+
+@pytest.mark.parametrize("kind, composition_mode", [("jpg", "normal"), ("png", "frame")])
+def test_compose_matches_baseline(kind, composition_mode):
+    item, template = sample_item(), sample_template(kind)
+    # center 배치: ((640 - 300) // 2, (480 - 240) // 2)
+    expected = baseline_compose(item, template, (170, 120), composition_mode)
+
+    data, _ = compose_one_bytes(item, template, composition_mode=composition_mode, out_format="PNG")
+
+    actual = np.asarray(Image.open(io.BytesIO(data)).convert("RGBA"))
+    assert np.array_equal(actual, np.asarray(expected))
+
+
+@pytest.mark.parametrize("blur_radius", [4, 6, 14, 24])
+def test_blur_alpha_close_to_gaussian(blur_radius):
+    # 축소 → blur → 확대 근사가 원본 해상도 GaussianBlur와 같은 퍼짐을 내는지
+    # (누끼 상품처럼 가장자리에 투명 여백이 있는 마스크)
+    alpha = Image.new("L", (480, 400), 0)
+    draw = ImageDraw.Draw(alpha)
+    draw.ellipse((80, 80, 400, 320), fill=255)
+    draw.rectangle((150, 100, 260, 200), fill=128)
+    expected = np.asarray(alpha.filter(ImageFilter.GaussianBlur(blur_radius)), dtype=np.int16)
+
+    actual = np.asarray(blur_alpha(alpha, blur_radius), dtype=np.int16)
+
+    diff = np.abs(actual - expected)
+    assert diff.max() <= 3
+    assert diff.mean() < 0.3